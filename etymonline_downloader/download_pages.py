@@ -5,21 +5,38 @@ download_pages
 # 2023-05-21
 
 
+import asyncio
+import gzip
+import json
+import re
 import sys
 from concurrent import futures
 from functools import cache
 from os import PathLike
 from pathlib import Path
 from string import ascii_lowercase
-from typing import Final, Iterator, NamedTuple
+from typing import AsyncIterator, Final, NamedTuple
 
-import requests
-from bs4 import BeautifulSoup
+import aiofiles
+import httpx
 from rich.console import Console
 from rich.progress import Progress, track
+from selectolax.lexbor import LexborHTMLParser
 
 SAVE_DIR: Final = Path(__file__).parent.joinpath("pages/")
 
+PAGE_COUNTS_PATH: Final = SAVE_DIR.joinpath("_page_counts.json")
+
+MAX_CONCURRENT_REQUESTS: Final = 200
+
+MAX_RETRIES: Final = 3
+RETRY_BACKOFF: Final = 0.3
+
+REQUEST_HEADERS: Final = {
+    "User-Agent": "etymonline_downloader/0.1.0",
+    "Accept-Encoding": "gzip, br",
+}
+
 
 class EntryPage(NamedTuple):
     content: str
@@ -33,24 +50,34 @@ class DownloadUpdate(NamedTuple):
     pages_total: int
 
 
-def get_soup_from_file(filename: PathLike | str) -> BeautifulSoup:
+def get_soup_from_file(filename: PathLike | str) -> LexborHTMLParser:
     path = Path(filename)
 
-    with open(path, "r") as infile:
-        text = infile.read()
+    with gzip.open(path, "rb") as infile:
+        return LexborHTMLParser(infile.read())
+
+
+def read_page_file(letter: str, page_number: int = 1) -> bytes:
+    with gzip.open(make_filepath(letter, page_number), "rb") as infile:
+        return infile.read()
+
 
-    return BeautifulSoup(text, "html.parser")
+_PAGINATION_PATTERN = re.compile(rb"ant-pagination(.*?)</ul>", re.DOTALL)
+_PAGE_NUMBER_PATTERN = re.compile(rb'title="(\d+)"')
 
 
-def get_letter_pages_count(soup: BeautifulSoup) -> int:
-    selected = soup.select("ul.ant-pagination li")
+def get_letter_pages_count(html: bytes) -> int:
+    pagination = _PAGINATION_PATTERN.search(html)
 
-    final_page_title = selected[-2].text
+    if pagination is None:
+        raise TypeError("Could not get page count")
+
+    page_numbers = _PAGE_NUMBER_PATTERN.findall(pagination.group(1))
 
-    if not final_page_title.isnumeric():
+    if not page_numbers:
         raise TypeError("Could not get page count")
 
-    return int(final_page_title)
+    return max(int(n) for n in page_numbers)
 
 
 def index_page_urls() -> list[str]:
@@ -60,48 +87,111 @@ def index_page_urls() -> list[str]:
 
 @cache
 def make_filepath(letter: str, page_number: int) -> Path:
-    return SAVE_DIR.joinpath(letter, f"{page_number:03d}_{letter.lower().strip()}.html")
+    return SAVE_DIR.joinpath(
+        letter, f"{page_number:03d}_{letter.lower().strip()}.html.gz"
+    )
+
+
+def make_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=4, max_keepalive_connections=4)
+    timeout = httpx.Timeout(30, connect=5)
+    return httpx.AsyncClient(
+        http2=True, limits=limits, timeout=timeout, headers=REQUEST_HEADERS
+    )
+
+
+def get_url(letter: str, page_number: int = 1) -> str:
+    return f"https://www.etymonline.com/search?q={letter}&page={page_number}"
+
+
+async def get_page(
+    client: httpx.AsyncClient, letter: str, page_number: int = 1
+) -> bytes:
+    url = get_url(letter, page_number=page_number)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            res = await client.get(url)
+            res.raise_for_status()
+            return res.content
+        except (httpx.HTTPError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(RETRY_BACKOFF * (2**attempt))
+
+    raise RuntimeError("unreachable")
+
 
+async def save_page(
+    client: httpx.AsyncClient, letter: str, page_number: int = 1
+) -> None:
+    target_file = make_filepath(letter, page_number)
 
-def download_index(letter: str):
-    if make_filepath(letter, 1).exists():
-        # print(f"Using cached page for '{letter}'")
+    if target_file.exists() and target_file.stat().st_size > 0:
+        # print(f"Using cached page for '{letter}' {page_number}")
         return
-    base_url = "https://www.etymonline.com/search?q="
-    get_page(base_url + letter)
-    save_page(letter)
 
+    content = await get_page(client, letter, page_number=page_number)
+
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+
+    async with aiofiles.open(target_file, "wb") as outfile:
+        await outfile.write(gzip.compress(content))
+
+
+async def _save_page_bounded(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    letter: str,
+    page_number: int = 1,
+) -> tuple[str, int]:
+    async with semaphore:
+        await save_page(client, letter, page_number=page_number)
+
+    return letter, page_number
 
-def fetch_index_pages():
-    failed: list[BaseException] = []
 
-    with futures.ProcessPoolExecutor() as exec:
-        downloads = [exec.submit(download_index, letter) for letter in ascii_lowercase]
+async def fetch_index_pages(
+    client: httpx.AsyncClient,
+) -> list[BaseException] | None:
+    failed: list[BaseException] = []
 
-        for completed in futures.as_completed(downloads):
-            process_err = completed.exception()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-            if process_err is not None:
-                failed.append(process_err)
-                print(process_err)
-                continue
+    downloads = [
+        asyncio.create_task(_save_page_bounded(client, semaphore, letter))
+        for letter in ascii_lowercase
+    ]
 
-        futures.wait(downloads)
+    for completed in asyncio.as_completed(downloads):
+        try:
+            await completed
+        except Exception as fetch_err:
+            failed.append(fetch_err)
+            print(fetch_err, file=sys.stderr)
 
     return failed if failed else None
 
 
-def parse_index_pages() -> dict[str, BeautifulSoup]:
-    fetch_index_pages()
-    processed_pages: dict[str, BeautifulSoup] = {}
+def fetch_index_pages_sync() -> list[BaseException] | None:
+    async def _run():
+        async with make_client() as client:
+            return await fetch_index_pages(client)
+
+    return asyncio.run(_run())
+
+
+def parse_index_pages() -> dict[str, LexborHTMLParser]:
+    fetch_index_pages_sync()
+    processed_pages: dict[str, LexborHTMLParser] = {}
 
-    parse_futures: dict[futures.Future[BeautifulSoup], str] = {}
+    parse_futures: dict[futures.Future[LexborHTMLParser], str] = {}
     failed = []
 
-    with futures.ProcessPoolExecutor() as executor:
+    with futures.ThreadPoolExecutor(max_workers=32) as executor:
         for path in (_path for _path in SAVE_DIR.iterdir() if _path.is_dir()):
             index_letter = path.name.strip()
-            letter_page_path = path.joinpath(f"001_{index_letter}.html")
+            letter_page_path = make_filepath(index_letter, 1)
             process = executor.submit(get_soup_from_file, letter_page_path)
 
             parse_futures[process] = index_letter
@@ -123,9 +213,7 @@ def parse_index_pages() -> dict[str, BeautifulSoup]:
     return processed_pages
 
 
-def parse_index_pages_sync() -> dict[str, BeautifulSoup]:
-    fetch_index_pages()
-
+def parse_index_pages_sync() -> dict[str, LexborHTMLParser]:
     pages = {}
 
     for path in (_path for _path in SAVE_DIR.iterdir() if _path.is_dir()):
@@ -138,99 +226,92 @@ def parse_index_pages_sync() -> dict[str, BeautifulSoup]:
 
 
 @cache
-def get_url(letter: str, page_number: int = 1) -> str:
-    return f"https://www.etymonline.com/search?q={letter}&page={page_number}"
-
-
-@cache
-def get_page(letter: str, page_number: int = 1) -> str:
-    url = get_url(letter, page_number=page_number)
-    res = requests.get(url)
-    res.raise_for_status()
-    return res.content.decode("utf-8")
-
-
-@cache
-def count_all_pages():
-    pages = parse_index_pages_sync()
-    return {k: get_letter_pages_count(v) for k, v in pages.items()}
+def count_all_pages() -> dict[str, int]:
+    if PAGE_COUNTS_PATH.exists():
+        return json.loads(PAGE_COUNTS_PATH.read_text())
 
+    counts = {}
 
-@cache
-def save_page(letter: str, page_number: int = 1) -> None:
-    target_path = SAVE_DIR.joinpath(letter.lower())
-
-    content = get_page(letter, page_number=page_number)
-
-    if not target_path.exists():
-        target_path.mkdir(parents=True, exist_ok=True)
+    for path in (_path for _path in SAVE_DIR.iterdir() if _path.is_dir()):
+        index_letter = path.name.strip()
+        counts[index_letter] = get_letter_pages_count(read_page_file(index_letter))
 
-    target_filename = f"{page_number:03d}_{letter.lower().strip()}.html"
+    PAGE_COUNTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    PAGE_COUNTS_PATH.write_text(json.dumps(counts))
 
-    with open(target_path.joinpath(target_filename), "w") as outfile:
-        outfile.write(content)
+    return counts
 
 
-def save_all_pages() -> Iterator[DownloadUpdate]:
-    fetch_index_pages()
+async def save_all_pages(
+    client: httpx.AsyncClient,
+) -> AsyncIterator[DownloadUpdate]:
+    await fetch_index_pages(client)
 
     page_counts = count_all_pages()
 
-    dl_futures: dict[futures.Future[None], tuple[str, int]] = {}
-
-    failed = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    with futures.ProcessPoolExecutor() as exec:
-        for letter, pages_count in page_counts.items():
-            # print(f"Fetching {letter} with {pages_count} pages")
+    updates: asyncio.Queue[DownloadUpdate | BaseException] = asyncio.Queue()
 
-            for n in range(1, pages_count + 1):
-                page_future = exec.submit(save_page, letter, n)
-                dl_futures[page_future] = (letter, n)
+    async def _save_and_report(letter: str, page_number: int) -> None:
+        try:
+            async with semaphore:
+                await save_page(client, letter, page_number=page_number)
+        except Exception as fetch_err:
+            print(fetch_err, file=sys.stderr)
+            await updates.put(fetch_err)
+            return
 
-                # print(f"\tSubmitting {letter}, page {n} of {pages_count}")
+        await updates.put(DownloadUpdate(letter, page_number, page_counts[letter]))
 
-        for done in futures.as_completed(dl_futures):
-            process_err = done.exception()
+    downloads = [
+        asyncio.create_task(_save_and_report(letter, n))
+        for letter, pages_count in page_counts.items()
+        for n in range(1, pages_count + 1)
+    ]
 
-            if process_err is not None:
-                failed.append(process_err)
-                print(process_err, file=sys.stderr)
-                continue
+    for _ in range(len(downloads)):
+        update = await updates.get()
 
-            done_letter, done_n = dl_futures[done]
+        if isinstance(update, BaseException):
+            continue
 
-            yield DownloadUpdate(done_letter, done_n, page_counts[done_letter])
+        yield update
 
-            # print(f"Fetched {done_letter} {done_n}/{page_counts[done_letter]}")
+        # print(f"Fetched {update.letter} {update.page_number}/{update.pages_total}")
 
 
-def full_download():
+async def _full_download() -> None:
     console = Console()
-    with console.status("Getting metadata..."):
-        fetch_index_pages()
-        index_pages = parse_index_pages_sync()
-        page_counts = {k: get_letter_pages_count(v) for k, v in index_pages.items()}
 
-        overall_sum = sum(page_counts.values())
+    async with make_client() as client:
+        with console.status("Getting metadata..."):
+            await fetch_index_pages(client)
+            page_counts = count_all_pages()
 
-    with Progress() as progress:
-        task = progress.add_task(description="Downloading entries", total=overall_sum)
-        for result in save_all_pages():
-            result_percent = (result.page_number / result.pages_total) * 100
+            overall_sum = sum(page_counts.values())
 
-            update_template = (
-                "Downloading section '{letter}' {n:03d}/{total:03d} ({percent:04.02f}%)"
+        with Progress() as progress:
+            task = progress.add_task(
+                description="Downloading entries", total=overall_sum
             )
+            async for result in save_all_pages(client):
+                result_percent = (result.page_number / result.pages_total) * 100
 
-            update_msg = update_template.format(
-                letter=result.letter,
-                n=result.page_number,
-                total=result.pages_total,
-                percent=result_percent,
-            )
+                update_template = "Downloading section '{letter}' {n:03d}/{total:03d} ({percent:04.02f}%)"
+
+                update_msg = update_template.format(
+                    letter=result.letter,
+                    n=result.page_number,
+                    total=result.pages_total,
+                    percent=result_percent,
+                )
 
-            progress.update(task, description=update_msg, advance=1)
+                progress.update(task, description=update_msg, advance=1)
+
+
+def full_download():
+    asyncio.run(_full_download())
 
 
 def main():
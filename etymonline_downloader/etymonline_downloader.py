@@ -2,12 +2,13 @@
 
 
 from .download_pages import full_download
-from .words_process import scrape_words
+from .words_process import export_entries, scrape_words
 
 
 def main():
     full_download()
     scrape_words()
+    export_entries()
 
 
 if __name__ == "__main__":
@@ -4,18 +4,30 @@ words_process
 
 # 2023-05-22
 
+import gzip
 import re
+import shelve
 import sqlite3
 from concurrent import futures
-from contextlib import suppress
 from pathlib import Path
-from typing import FrozenSet, Iterator, NamedTuple, Optional
+from typing import Final, Iterable, Iterator, NamedTuple, Optional
 
-from bs4 import BeautifulSoup
+import orjson
 from rich.progress import track
+from selectolax.lexbor import LexborHTMLParser
 
 from .download_pages import SAVE_DIR
 
+PARSE_CACHE_PATH = Path(__file__).parent.joinpath(".parsed_cache")
+
+DB_PATH = Path(__file__).parent.joinpath("words.db")
+
+ENTRIES_JSON_PATH = Path(__file__).parent.joinpath("entries.json")
+
+WRITE_BATCH_SIZE: Final = 1000
+
+PARSE_CHUNK_SIZE: Final = 32
+
 
 class WordEntry(NamedTuple):
     name: str
@@ -23,13 +35,20 @@ class WordEntry(NamedTuple):
     pos: str | None = None
 
 
+_ESC_PATTERN = re.compile(r"\\x\S*")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_NEWLINE_PATTERN = re.compile(r"\n+")
+_NONALNUM_PATTERN = re.compile(r"[^0-9A-Za-z]+")
+
+
+def strip_nonalnum(token: str) -> str:
+    return _NONALNUM_PATTERN.sub("", token)
+
+
 def format_pos(token: str | None):
     if token is None:
         return None
 
-    def strip_nonalnum(t: str):
-        return "".join([c for c in t if c.isalnum()])
-
     if "," in token:
         elements = token.split(",")
         return ", ".join(strip_nonalnum(e) for e in elements)
@@ -38,19 +57,23 @@ def format_pos(token: str | None):
 
 
 def clean_html_content(content: str):
-    chars_replaced = re.sub(r"\\x\S*", "", content.strip())
+    chars_replaced = _ESC_PATTERN.sub("", content.strip())
 
-    whitespace_cleaned = re.sub(r"\s+", " ", chars_replaced)
+    whitespace_cleaned = _WHITESPACE_PATTERN.sub(" ", chars_replaced)
 
-    return re.sub(r"\n+", "\n", whitespace_cleaned)
+    return _NEWLINE_PATTERN.sub("\n", whitespace_cleaned)
 
 
-def iter_page_words(soup: BeautifulSoup):
-    words_matches = soup.select('div[class^="word"]')
+def iter_page_words(tree: LexborHTMLParser):
+    words_matches = tree.css('div[class^="word"]')
 
     for word in words_matches:
-        name_sel = word.select('a[class^="word__name"]')
-        name = name_sel[0].text
+        name_node = word.css_first('a[class^="word__name"]')
+
+        if name_node is None:
+            continue
+
+        name = name_node.text()
 
         pos = None
 
@@ -60,9 +83,9 @@ def iter_page_words(soup: BeautifulSoup):
 
             pos = format_pos(entry_parts[1])
 
-        content_sel = word.select("p")
+        content_sel = word.css("p")
 
-        content_cleaned = [c.text.replace("\n", "") for c in content_sel]
+        content_cleaned = [c.text().replace("\n", "") for c in content_sel]
         content = "\n".join(content_cleaned)
 
         name = clean_html_content(name)
@@ -73,25 +96,33 @@ def iter_page_words(soup: BeautifulSoup):
 
 
 def iter_local_paths(start_dir: Path | str = SAVE_DIR) -> Iterator[Path]:
-    start_dir = Path(start_dir)
-    for item in start_dir.iterdir():
-        if item.is_dir():
-            yield from iter_local_paths(start_dir=item)
-            continue
+    return Path(start_dir).rglob("*.html.gz")
+
 
-        yield item
+def parse_cache_key(filepath: Path) -> str:
+    stat = filepath.stat()
+    return f"{filepath}:{stat.st_mtime_ns}:{stat.st_size}"
 
 
-def words_from_file(filepath: Path):
-    with open(filepath, "r") as infile:
-        soup = BeautifulSoup(infile, "html.parser")
+def words_from_file(filepath: Path) -> list[WordEntry]:
+    with gzip.open(filepath, "rb") as infile:
+        tree = LexborHTMLParser(infile.read())
 
-    words = frozenset(iter_page_words(soup))
-    return words
+    return list(iter_page_words(tree))
 
 
 class DbWriter:
-    insert_query = "INSERT INTO words (name, content, pos) VALUES (?, ?, ?)"
+    insert_query = "INSERT OR IGNORE INTO words (name, content, pos) VALUES (?, ?, ?)"
+    insert_query_strict = "INSERT INTO words (name, content, pos) VALUES (?, ?, ?)"
+
+    setup_pragmas = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-262144",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA locking_mode=EXCLUSIVE",
+    )
 
     def __init__(
         self,
@@ -99,7 +130,7 @@ class DbWriter:
         ignore_duplicate: bool = True,
     ) -> None:
         if db_path is None:
-            db_path = Path(__file__).parent.joinpath("words.db")
+            db_path = DB_PATH
         else:
             db_path = Path(db_path)
 
@@ -109,9 +140,12 @@ class DbWriter:
         print(f"Saving words to {db_path}")
 
     def __enter__(self):
-        self.connection = sqlite3.connect(self.db_path)
+        self.connection = sqlite3.connect(self.db_path, isolation_level=None)
         self.cursor = self.connection.cursor()
 
+        for pragma in self.setup_pragmas:
+            self.cursor.execute(pragma)
+
         try:
             self.cursor.execute(
                 """
@@ -126,44 +160,82 @@ class DbWriter:
         except sqlite3.OperationalError:
             pass
 
-        self.connection.commit()
+        self.cursor.execute("BEGIN")
         return self
 
     def __exit__(self, exc_type: type, exc_value: BaseException, traceback):
         if self.ignore_duplicate and isinstance(exc_value, sqlite3.IntegrityError):
             return True
 
-        self.connection.commit()
+        self.cursor.execute("COMMIT")
         self.connection.close()
 
         return False
 
-    def write_single_word(self, word: WordEntry):
-        if not self.ignore_duplicate:
-            self.cursor.execute(self.insert_query, word)
-            return
+    def write_many(self, words: Iterable[WordEntry]) -> None:
+        query = self.insert_query if self.ignore_duplicate else self.insert_query_strict
+        self.cursor.executemany(query, words)
 
-        with suppress(sqlite3.IntegrityError):
-            self.cursor.execute(self.insert_query, word)
 
-    def write_words(self, words: FrozenSet[WordEntry]):
-        for word in words:
-            self.write_single_word(word)
+def scrape_words():
+    paths = list(iter_local_paths())
 
+    with shelve.open(str(PARSE_CACHE_PATH)) as parse_cache:
+        cache_keys = {path: parse_cache_key(path) for path in paths}
+        pending = [path for path in paths if cache_keys[path] not in parse_cache]
 
-def scrape_words():
-    with futures.ProcessPoolExecutor() as executor:
-        processes = [
-            executor.submit(words_from_file, file) for file in iter_local_paths()
-        ]
-
-        with DbWriter() as db:
-            for result in track(
-                futures.as_completed(processes),
-                total=len(processes),
-                description="Parsing words into database...",
-            ):
-                db.write_words(result.result())
+        with futures.ProcessPoolExecutor() as executor:
+            results = executor.map(
+                words_from_file, pending, chunksize=PARSE_CHUNK_SIZE
+            )
+
+            with DbWriter() as db:
+                buffer: list[WordEntry] = []
+
+                def flush():
+                    db.write_many(buffer)
+                    buffer.clear()
+
+                for path in paths:
+                    key = cache_keys[path]
+                    if key in parse_cache:
+                        buffer.extend(parse_cache[key])
+
+                    if len(buffer) >= WRITE_BATCH_SIZE:
+                        flush()
+
+                for path, words in track(
+                    zip(pending, results),
+                    total=len(pending),
+                    description="Parsing words into database...",
+                ):
+                    parse_cache[cache_keys[path]] = words
+                    buffer.extend(words)
+
+                    if len(buffer) >= WRITE_BATCH_SIZE:
+                        flush()
+
+                flush()
+
+
+def export_entries(json_path: Optional[Path | str] = None) -> None:
+    if json_path is None:
+        json_path = ENTRIES_JSON_PATH
+
+    connection = sqlite3.connect(DB_PATH)
+
+    rows = connection.execute("SELECT name, content, pos FROM words")
+
+    with open(json_path, "wb") as outfile:
+        for name, content, pos in rows:
+            outfile.write(
+                orjson.dumps(
+                    {"name": name, "content": content, "pos": pos},
+                    option=orjson.OPT_APPEND_NEWLINE,
+                )
+            )
+
+    connection.close()
 
 
 def main():